@@ -3,8 +3,6 @@ import tqdm
 from typing import List, Tuple
 
 import h5py
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, Dataset
@@ -160,6 +158,10 @@ class Hdf5Dataset(Dataset):
         to the "url_plot_dest" folder.
         '''
 
+        # matplotlib is only imported when plotting, its import is slow
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.axes_grid1 import make_axes_locatable
+
         if data_single.shape != (self.C, self.N, self.N):
             raise ValueError('Batch data has the wrong shape.')
 
@@ -225,7 +225,7 @@ class ImageResizeDataset(Dataset):
 
         # This step interpolates the data using PyTorch
         arr = torch.tensor(arr)
-        arr = F.interpolate(arr.unsqueeze(0), self.low_resolution, mode="area").squeeze(0)
+        arr = F.interpolate(arr[None], self.low_resolution, mode="area")[0]
 
         if self.plot:
             plt.imshow(arr)
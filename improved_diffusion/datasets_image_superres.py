@@ -1,13 +1,37 @@
+import glob
+import hashlib
 import os
+import tempfile
+from functools import partial
 from typing import List, Tuple
 
 import blobfile as bf
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch.utils.data.dataloader import default_collate
+
+
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "gif"})
+
+
+def _walk_image_files(
+        data_dir: str):
+    """
+    Yields the image files of a local directory, in sorted order.
+    os.scandir gives the entry type without an extra stat per entry.
+    """
+    with os.scandir(data_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_file():
+            name, dot, ext = entry.name.rpartition(".")
+            if dot and ext.lower() in IMAGE_EXTENSIONS:
+                yield entry.path
+        elif entry.is_dir():
+            yield from _walk_image_files(entry.path)
 
 
 def list_image_files_recursively(
@@ -15,15 +39,101 @@ def list_image_files_recursively(
     """
     List image files in a data directory.
     """
-    results = []
-    for entry in sorted(bf.listdir(data_dir)):
-        full_path = bf.join(data_dir, entry)
-        ext = entry.split(".")[-1]
-        if "." in entry and ext.lower() in ["jpg", "jpeg", "png", "gif"]:
-            results.append(full_path)
-        elif bf.isdir(full_path):
-            results.extend(list_image_files_recursively(full_path))
-    return results
+    return list(_walk_image_files(data_dir))
+
+
+def collate_superres(
+        batch: List[Tuple[np.ndarray, dict]],
+        low_resolution: int
+        ) -> Tuple[torch.Tensor, dict]:
+    """
+    Writes the uint8 high-resolution images of the batch, rescaled to
+    [-1, 1], into a single (B, C, H, W) float tensor, and computes all
+    the low-resolution images at once from this block.
+    """
+    images, out_dicts = zip(*batch)
+
+    # Inside a worker, the batch is allocated directly in shared memory,
+    # as default_collate does, so that it is not copied again when sent
+    # to the main process
+    shape = (len(images),) + images[0].shape
+    if torch.utils.data.get_worker_info() is not None:
+        elem = torch.empty(0, dtype=torch.float32)
+        storage = elem._typed_storage()._new_shared(int(np.prod(shape)))
+        arr = elem.new(storage).resize_(shape)
+    else:
+        arr = torch.empty(shape, dtype=torch.float32)
+
+    # This step rescales the whole uint8 batch to [-1, 1] at once,
+    # writing directly into the float32 batch
+    arr_np = arr.numpy()
+    np.multiply(np.stack(images), np.float32(1 / 127.5), out=arr_np,
+                dtype=np.float32)
+    arr_np -= np.float32(1.0)
+
+    out_dict = default_collate(list(out_dicts))
+    # The low-resolution conditioning image is stored in float16 to halve
+    # the host to GPU transfer, SuperResModel casts it back to float32
+    out_dict["low_res"] = F.interpolate(
+        arr, low_resolution, mode="area").to(torch.float16)
+    return arr, out_dict
+
+
+def worker_init_superres(
+        worker_id: int) -> None:
+    """
+    Gives each DataLoader worker its own random generator for the
+    crops, seeded from the per-worker seed set by PyTorch.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    worker_info.dataset.reset_rng(worker_info.seed)
+
+
+def keep_sample(
+        sample: Tuple[np.ndarray, dict]
+        ) -> Tuple[np.ndarray, dict]:
+    """
+    Identity collate_fn, used when the samples are batched
+    outside of the DataLoader.
+    """
+    return sample
+
+
+class BatchedLoader:
+    """
+    Groups the single samples yielded by a DataLoader into batches.
+
+    With an IterableDataset and batch_size=None, the DataLoader fetches
+    the samples from its workers in a round-robin manner, so that all
+    the workers contribute to each batch instead of one worker building
+    a whole batch.
+    """
+
+    def __init__(
+            self,
+            loader: DataLoader,
+            batch_size: int,
+            collate_fn,
+            drop_last: bool = True):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.loader.dataset) // self.batch_size
+        return -(-len(self.loader.dataset) // self.batch_size)
+
+    def __iter__(self):
+        batch = []
+        for sample in self.loader:
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield self.collate_fn(batch)
+                batch = []
+        if batch and not self.drop_last:
+            yield self.collate_fn(batch)
 
 
 def load_data_superres(
@@ -37,7 +147,14 @@ def load_data_superres(
         num_class: int = None,
         deterministic: bool = False,
         crop: bool = False,
-        droplast: bool = True
+        droplast: bool = True,
+        num_workers: int = None,
+        pin_memory: bool = True,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = True,
+        cache: bool = False,
+        preload: bool = False,
+        interleave_workers: bool = False
         ):
     """
     Creates a generator over (images, kwargs) pairs given a dataset.
@@ -75,6 +192,36 @@ def load_data_superres(
 
         crop (bool): if True, randomly crops the image
             to the desired image_size
+
+        droplast (bool): if True, drops the last few examples of the
+            dataset to work with a whole number of batches.
+
+        num_workers (int): number of DataLoader worker processes. If None,
+            half of the available CPUs are used, up to 8.
+
+        pin_memory (bool): if True, batches are copied into pinned memory
+            to speed up host to GPU transfers.
+
+        prefetch_factor (int): number of batches loaded in advance
+            by each worker.
+
+        persistent_workers (bool): if True, workers are kept alive
+            between epochs.
+
+        cache (bool): if True, the decoded images are cached once in
+            a memory-mapped file inside data_dir (unless crop is True).
+            data_dir must then be writable. The cache is rebuilt when
+            the images of data_dir change.
+
+        preload (bool): if True, all the decoded images are kept in a
+            shared-memory tensor (unless crop is True). Only suitable
+            for datasets that fit in RAM.
+
+        interleave_workers (bool): if True, the workers yield single
+            samples in turn, which are batched in the main process by a
+            BatchedLoader. This reduces the time to the first batch, at
+            the cost of collating (and not pinning) the batches in the
+            main process.
     """
     # Check inputs
     if not data_dir:
@@ -87,9 +234,12 @@ def load_data_superres(
     if class_cond:
         # Assume classes are the first part of the filename,
         # before an underscore.
-        class_names = [bf.basename(path).split("_")[0] for path in all_files]
-        sorted_classes = {x: i for i, x in enumerate(sorted(set(class_names)))}
-        classes = [sorted_classes[x] for x in class_names]
+        # np.unique returns the sorted class names and the index of
+        # each file's class in a single pass
+        class_names = np.array(
+            [bf.basename(path).split("_", 1)[0] for path in all_files])
+        sorted_classes, classes = np.unique(class_names, return_inverse=True)
+        classes = classes.astype(np.int64)
         if num_class != len(sorted_classes):
             raise ValueError('Difference between the number of classes when reading the data and the input number of classes.')
 
@@ -99,24 +249,42 @@ def load_data_superres(
         num_channels,
         all_files,
         classes=classes,
-        crop=crop)
-
-    return (
-        DataLoader(
-            dataset,
-            batch_size=batch_size,
-            shuffle=False,
-            num_workers=1,
-            drop_last=droplast,
+        crop=crop,
+        cache_dir=data_dir if cache else None,
+        preload=preload)
+
+    if num_workers is None:
+        num_workers = min(8, (os.cpu_count() or 1) // 2)
+
+    collate_fn = partial(collate_superres, low_resolution=image_size_lr)
+
+    if interleave_workers:
+        # Each worker prefetches its share of prefetch_factor batches
+        loader = DataLoader(
+            IterableImageDatasetSuperres(dataset, shuffle=not deterministic),
+            batch_size=None,
+            num_workers=num_workers,
+            prefetch_factor=(-(-prefetch_factor * batch_size // num_workers)
+                             if num_workers > 0 else None),
+            persistent_workers=persistent_workers and num_workers > 0,
+            collate_fn=keep_sample,
+            worker_init_fn=worker_init_superres,
         )
-        if deterministic
-        else DataLoader(
-            dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            num_workers=1,
-            drop_last=droplast,
-         )
+        return BatchedLoader(loader, batch_size, collate_fn,
+                             drop_last=droplast)
+
+    # prefetch_factor and persistent_workers are only valid with workers
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=not deterministic,
+        num_workers=num_workers,
+        drop_last=droplast,
+        pin_memory=pin_memory,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=persistent_workers and num_workers > 0,
+        collate_fn=collate_fn,
+        worker_init_fn=worker_init_superres,
     )
 
 
@@ -130,14 +298,17 @@ class ImageDatasetSuperres(Dataset):
             image_paths: List[str],
             classes: List[str] = None,
             plot: bool = False,
-            crop: bool = False):
+            crop: bool = False,
+            cache_dir: str = None,
+            preload: bool = False):
         '''
         Inputs:
         -------
             resolution (int): desired size for the images, not
                 necessarily the native resolution.
 
-            low_resolution (int): size of the downsampled image
+            low_resolution (int): size of the downsampled image,
+                computed per batch in collate_superres
 
             num_channels (int): nbr of channels of the input
                 image.
@@ -150,27 +321,157 @@ class ImageDatasetSuperres(Dataset):
 
             crop (bool): if True, randomly crops the image
                 to the desired image resolution.
+
+            cache_dir (str): if not None, the decoded and resized
+                images are stored once in a uint8 memory-mapped file
+                in this directory, and read from it afterwards.
+                The file name contains a hash of the image paths, sizes
+                and modification times, so a stale cache is never read.
+                Ignored if crop is True, since crops are random.
+
+            preload (bool): if True, all the decoded images are stored
+                once in a (N, C, H, W) uint8 tensor in shared memory, so
+                that the DataLoader workers only index into it.
+                Ignored if crop is True, since crops are random.
         '''
         super().__init__()
         self.resolution = resolution
         self.low_resolution = low_resolution
         self.num_channels = num_channels
         self.local_images = image_paths
-        self.local_classes = None if classes is None else classes
+        self.local_classes = (None if classes is None
+                              else np.asarray(classes, dtype=np.int64))
         self.plot = plot
         self.crop = crop
+        self._rng = None
+
+        # The conversion to an array only depends on the number of
+        # channels, so it is chosen once here rather than per sample
+        if num_channels == 3:
+            self._to_array = self._to_array_rgb
+        elif num_channels == 1:
+            self._to_array = self._to_array_gray
+        else:
+            raise ValueError('We require either 1 or 3 channels.')
+
+        self.cache_path = None
+        self._cache = None
+        if cache_dir is not None and not crop:
+            self.cache_prefix = \
+                f".cache_{num_channels}x{resolution}x{resolution}_"
+            self.cache_path = os.path.join(
+                cache_dir, f"{self.cache_prefix}{self._fingerprint()}.bin")
+            self._build_cache()
+
+        self.preloaded = None
+        if preload and not crop:
+            self.preloaded = torch.empty(
+                self.cache_shape, dtype=torch.uint8).share_memory_()
+            if self.cache_path is not None:
+                self.preloaded.numpy()[:] = self._get_cache()
+            else:
+                self._decode_all(self.preloaded.numpy())
 
     def __len__(self):
         return len(self.local_images)
 
-    def __getitem__(
+    @property
+    def cache_shape(self) -> Tuple[int, int, int, int]:
+        return (len(self.local_images), self.num_channels,
+                self.resolution, self.resolution)
+
+    def _fingerprint(self) -> str:
+        """
+        Hash of the resize settings and of the path, size and
+        modification time of each image, in dataset order. It is part
+        of the cache file name, so that the cache is rebuilt whenever
+        the images of the data directory change.
+        """
+        fingerprint = hashlib.sha1(
+            f"{self.cache_shape[1:]},BOX-power-of-two,BICUBIC".encode())
+        for path in self.local_images:
+            stat = os.stat(path)
+            fingerprint.update(
+                f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return fingerprint.hexdigest()[:16]
+
+    def _build_cache(self) -> None:
+        """
+        Decodes all the images once into a (N, C, H, W) uint8
+        memory-mapped file at 'self.cache_path'. An existing file of
+        the right size is reused as is, and the caches built from
+        previous versions of the images are removed.
+        """
+        nbytes = int(np.prod(self.cache_shape))
+        if (os.path.exists(self.cache_path)
+                and os.path.getsize(self.cache_path) == nbytes):
+            return
+
+        cache_dir = os.path.dirname(self.cache_path)
+        if not os.access(cache_dir, os.W_OK):
+            raise ValueError(f'Cannot write the image cache, the directory {cache_dir} is not writable. Disable the cache.')
+
+        # Write to a unique temporary file first, so that an interrupted
+        # run does not leave a truncated cache behind and concurrent runs
+        # do not write to the same file
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=self.cache_prefix, suffix='.tmp', dir=cache_dir)
+        os.close(fd)
+        try:
+            cache = np.memmap(tmp_path, dtype=np.uint8, mode='w+',
+                              shape=self.cache_shape)
+            self._decode_all(cache)
+            cache.flush()
+            del cache
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        # Remove the stale caches, built from previous versions of the images
+        pattern = os.path.join(glob.escape(cache_dir),
+                               glob.escape(self.cache_prefix) + '*.bin')
+        for path in glob.glob(pattern):
+            if path != self.cache_path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _decode_all(
+            self,
+            out: np.ndarray) -> None:
+        """
+        Writes all the decoded images into 'out' of shape
+        'self.cache_shape'.
+        """
+        for idx in range(len(self.local_images)):
+            out[idx] = self._load_image(idx)
+
+    def _get_cache(self) -> np.memmap:
+        # Opened lazily so that each DataLoader worker maps the file itself
+        if self._cache is None:
+            self._cache = np.memmap(self.cache_path, dtype=np.uint8,
+                                    mode='r', shape=self.cache_shape)
+        return self._cache
+
+    def reset_rng(
+            self,
+            seed: int = None) -> None:
+        self._rng = np.random.default_rng(seed)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def _load_image(
             self,
             idx: int
-            ) -> Tuple[np.ndarray, dict]:
+            ) -> np.ndarray:
         """
-        Outputs the image in format (C, H, W) along with a dictionary
-        containing the image label (if class_cond is True) and the
-        low-resolution image.
+        Reads, crops/resizes and converts the image to a uint8
+        array in [0, 255] of format (C, H, W).
         """
         path = self.local_images[idx]
 
@@ -183,21 +484,29 @@ class ImageDatasetSuperres(Dataset):
             if width < self.resolution or height < self.resolution:
                 raise ValueError('The data cannot be cropped to the desired resolution!')
             # Randomly crop a portion of the image
-            left, bottom = np.random.randint(0, width - self.resolution),\
-                np.random.randint(0, height - self.resolution)
+            if self._rng is None:
+                # Without workers, follow the torch seed like the workers do
+                self.reset_rng(torch.initial_seed())
+            left, bottom = self._rng.integers(
+                0, [width - self.resolution + 1, height - self.resolution + 1])
             pil_image = pil_image.crop((left, bottom,
                                         left + self.resolution,
                                         bottom + self.resolution))
 
         else:
-            # We are not on a new enough PIL to support the `reducing_gap`
-            # argument, which uses BOX downsampling at powers of two first.
-            # Thus, we do it by hand to improve downsample quality.
-            while min(*pil_image.size) >= 2 * self.resolution:
-                pil_image = pil_image.resize(
-                    tuple(x // 2 for x in pil_image.size),
-                    resample=Image.BOX
-                )
+            # BOX downsampling at powers of two first improves downsample
+            # quality. Image.reduce does all the halvings in a single call,
+            # the box keeps the sizes given by halving the image by hand.
+            factor = 1
+            while min(*pil_image.size) >= 2 * factor * self.resolution:
+                factor *= 2
+            if factor > 1:
+                width, height = pil_image.size
+                pil_image = pil_image.reduce(
+                    factor,
+                    box=(0, 0,
+                         width // factor * factor,
+                         height // factor * factor))
 
             scale = self.resolution / min(*pil_image.size)
             pil_image = pil_image.resize(
@@ -206,43 +515,119 @@ class ImageDatasetSuperres(Dataset):
             )
 
         # This step converts the image to an array in [0, 255]
-        if self.num_channels == 3:
-            arr = np.array(pil_image.convert("RGB"))
-        elif self.num_channels == 1:
-            # Convert to grayscale
-            arr = np.expand_dims(np.array(pil_image.convert('L')), axis=2)
-        else:
-            raise ValueError('We require either 1 or 3 channels.')
+        arr = self._to_array(pil_image)
 
-        if arr.shape != (self.resolution, self.resolution, self.num_channels):
+        if arr.shape[1:] != (self.resolution, self.resolution):
             raise ValueError('The current image is not of the right size.')
 
-        crop_y = (arr.shape[0] - self.resolution) // 2
-        crop_x = (arr.shape[1] - self.resolution) // 2
-        arr = arr[crop_y: crop_y + self.resolution,
-                  crop_x: crop_x + self.resolution]
+        return arr
+
+    @staticmethod
+    def _to_array_rgb(
+            pil_image: Image.Image
+            ) -> np.ndarray:
+        """
+        Converts the image to a (3, H, W) uint8 array, converting
+        it to RGB only if needed.
+        """
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        return np.asarray(pil_image).transpose(2, 0, 1)
+
+    @staticmethod
+    def _to_array_gray(
+            pil_image: Image.Image
+            ) -> np.ndarray:
+        """
+        Converts the image to a (1, H, W) uint8 array, converting
+        it to grayscale only if needed.
+        """
+        if pil_image.mode != "L":
+            pil_image = pil_image.convert("L")
+        return np.asarray(pil_image)[None]
 
-        # This step rescales the array to [-1, 1]
-        arr = arr.astype(np.float32) / 127.5 - 1
+    def __getitem__(
+            self,
+            idx: int
+            ) -> Tuple[np.ndarray, dict]:
+        """
+        Outputs the uint8 image in format (C, H, W) along with a
+        dictionary containing the image label (if class_cond is True).
+        The rescaling to [-1, 1] and the low-resolution image are done
+        per batch by collate_superres.
+        """
+        if self.preloaded is not None:
+            arr = self.preloaded[idx].numpy()
+        elif self.cache_path is not None:
+            arr = self._get_cache()[idx]
+        else:
+            arr = self._load_image(idx)
 
         if self.plot:
-            plt.imshow(arr)
+            # matplotlib is only imported when plotting, so that the
+            # DataLoader workers do not pay for its import
+            import matplotlib.pyplot as plt
+            plt.imshow(np.moveaxis(arr, 0, -1).squeeze())
             plt.colorbar()
             plt.show()
 
-        # This step reorders the array dimensions
-        arr = np.transpose(arr, [2, 0, 1])
-
-        # Create dictionary with label/low_res data
+        # Create dictionary with label data
         out_dict = {}
 
         # Add class data
         if self.local_classes is not None:
-            out_dict["y"] = np.array(self.local_classes[idx], dtype=np.int64)
+            out_dict["y"] = self.local_classes[idx]
 
-        # Add LR data
-        arr = torch.tensor(arr)
-        arr = arr.unsqueeze(0)
-        out_dict["low_res"] = F.interpolate(arr, self.low_resolution, mode="area").squeeze(0)
+        return arr, out_dict
 
-        return arr.squeeze(0), out_dict
+
+class IterableImageDatasetSuperres(IterableDataset):
+
+    def __init__(
+            self,
+            dataset: ImageDatasetSuperres,
+            shuffle: bool = True):
+        '''
+        Iterates over an ImageDatasetSuperres one sample at a time,
+        each DataLoader worker reading a disjoint part of the indices.
+
+        Inputs:
+        -------
+            dataset (ImageDatasetSuperres): the dataset to iterate over.
+
+            shuffle (bool): if True, the indices are shuffled at
+                each epoch.
+        '''
+        super().__init__()
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def reset_rng(
+            self,
+            seed: int = None) -> None:
+        self.dataset.reset_rng(seed)
+
+    def __iter__(self):
+        indices = np.arange(len(self.dataset))
+        worker_info = torch.utils.data.get_worker_info()
+
+        if self.shuffle:
+            # All the workers must draw the same permutation to split it.
+            # PyTorch gives them a common base seed, and the epoch count
+            # changes the permutation when the workers are persistent.
+            # Without workers, the permutation follows the torch seed.
+            base_seed = (torch.initial_seed() if worker_info is None
+                         else worker_info.seed - worker_info.id)
+            seed = [base_seed, self._epoch]
+            indices = np.random.default_rng(seed).permutation(indices)
+        self._epoch += 1
+
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+
+        for idx in indices:
+            yield self.dataset[idx]
@@ -11,7 +11,6 @@ from tqdm.auto import tqdm
 from typing import Tuple
 
 import h5py
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
@@ -635,6 +634,8 @@ class GaussianDiffusion:
             # Dictionary that contains 'sample' and 'pred_xstart'
             final = out
             if show:
+                # matplotlib is only imported when plotting, its import is slow
+                import matplotlib.pyplot as plt
                 plt.imshow(final['pred_xstart'].detach().cpu().numpy()[0, 0, :, :])
                 plt.colorbar()
                 plt.savefig(f'{folder_img}/pred_xstart_{idx}.png')
@@ -667,7 +667,8 @@ class SuperResModel(UNetModel):
             ) -> torch.Tensor:
 
         new_height, new_width = x.shape[-2:]
-        upsampled = F.interpolate(low_res, (new_height, new_width),
+        # low_res may be stored in float16 by the data loader
+        upsampled = F.interpolate(low_res.to(x.dtype), (new_height, new_width),
                                   mode="bilinear")
         x = torch.cat([x, upsampled], dim=1)
 
@@ -682,7 +683,7 @@ class SuperResModel(UNetModel):
             ) -> torch.Tensor:
 
         _, new_height, new_width, _ = x.shape
-        upsampled = F.interpolate(low_res, (new_height, new_width),
+        upsampled = F.interpolate(low_res.to(x.dtype), (new_height, new_width),
                                   mode="bilinear")
         x = torch.cat([x, upsampled], dim=1)
 
@@ -5,8 +5,6 @@ numpy array. This can be used to produce samples for FID evaluation.
 import os
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 import torch
 import tqdm
@@ -180,6 +178,10 @@ def main_sample(
         all_images.append(sample.cpu().numpy())
 
         if plot:
+            # matplotlib is only imported when plotting, its import is slow
+            import matplotlib.pyplot as plt
+            from mpl_toolkits.axes_grid1 import make_axes_locatable
+
             for i in range(all_images[-1].shape[0]):
                 plt.figure(figsize=(10, 10))
                 ax = plt.gca()
@@ -1,6 +1,6 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
+from PIL import Image
 from sample import main_sample
 
 if __name__ == "__main__":
@@ -51,13 +51,12 @@ if __name__ == "__main__":
     png_save_path = os.path.join(url_save_path, 'png_samples/')
     os.makedirs(png_save_path, exist_ok=True)
 
-    # Iterate over the samples and save each one as a PNG file
-    for i in range(samples.shape[0]):
-        plt.figure(figsize=(4, 4))
-        plt.imshow(samples[i, :, :, 0], cmap='gray')
-        plt.axis('off')
-        plt.tight_layout()
-        plt.savefig(os.path.join(png_save_path, f'sample_{i+1}.png'), dpi=300, bbox_inches='tight', pad_inches=0)
-        plt.close()
+    # Rescale all the samples from [-1, 1] to uint8 [0, 255] at once
+    samples_uint8 = ((samples[..., 0] + 1) * 127.5).clip(0, 255).astype(np.uint8)
+
+    # Iterate over the samples and save each one as a grayscale PNG file
+    for i in range(samples_uint8.shape[0]):
+        Image.fromarray(samples_uint8[i]).save(
+            os.path.join(png_save_path, f'sample_{i+1}.png'))
 
     print(f"Samples saved as PNG files in {png_save_path}")
@@ -5,7 +5,6 @@ from typing import List
 
 import h5py
 import json
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 from torch.utils.data import DataLoader
@@ -210,6 +209,8 @@ def save_sample_to_png(
         url_save_png = f'{url_save_folder}/{name_save_png}.png'
 
     if plot:
+        # matplotlib is only imported when plotting, its import is slow
+        import matplotlib.pyplot as plt
         plt.imshow(arr, vmin=-1, vmax=1)
         plt.show()
 